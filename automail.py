@@ -1,32 +1,140 @@
-import win32com.client
+import io
 import os
+import mmap
+import sys
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import certifi
 import datetime
 import re
 import sqlite3
+import logging
+import logging.handlers
+import tempfile
+import hashlib
+import gzip
+import random
+import queue
+import signal
+import threading
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:  # orjson é opcional; sem ele usa o json da biblioteca padrão
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
 load_dotenv()
 
+log = logging.getLogger("automail")
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+SEND_MESSAGE_URL = f"{TELEGRAM_API_URL}/sendMessage"
+SEND_DOCUMENT_URL = f"{TELEGRAM_API_URL}/sendDocument"
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Campos fixos de cada envio; a cada chamada só se copia e preenche o que muda
+MESSAGE_TEMPLATE = {"chat_id": CHAT_ID, "text": None, "parse_mode": "HTML"}
+DOCUMENT_TEMPLATE = {"chat_id": CHAT_ID, "document": None}
+GZIP_JSON_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+# Compacta com gzip os textos (JSON) acima de COMPRESS_MIN_BYTES; desativado por padrão
+COMPRESS = os.getenv("TELEGRAM_COMPRESS", "0").lower() in ("1", "true", "sim")
+COMPRESS_MIN_BYTES = 512
 
 DB_FILE = "email_sent.db"
+# Pasta para os anexos temporários; pode apontar para um RAM disk (ex.: R:\ ou /dev/shm)
+TMP_ROOT = os.getenv("AUTOMAIL_TMP_ROOT") or tempfile.gettempdir()
+ATTACH_DIR = os.path.join(TMP_ROOT, "automail_anexos")
+# Limite de espaço para anexos salvos que ainda aguardam envio
+MAX_PENDING_BYTES = int(os.getenv("AUTOMAIL_ATTACH_CACHE_MB", "512")) * 1024 * 1024
+# Anexos menores que isso (ex.: logotipos de assinatura) não são enviados; 0 desativa
+MIN_ATTACHMENT_BYTES = int(os.getenv("AUTOMAIL_MIN_ATTACHMENT_BYTES", "0"))
+DATE_FORMAT = "%d/%m/%Y - %H:%M"  # Formato das datas nos logs (e do sent_at antigo)
+POLL_INTERVAL = 300  # Segundos entre verificações da caixa de entrada
 SKIP_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif"}  # Extensões de imagem para ignorar
 
+class JitterRetry(Retry):
+    # Soma um atraso aleatório ao backoff exponencial para não sincronizar as novas tentativas
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, 0.25) if backoff > 0 else backoff
+
+# sendMessage tem corpo pequeno e reenviável: repete em falhas de conexão,
+# timeouts de leitura, 429 (respeitando Retry-After) e 5xx.
+MESSAGE_RETRY = JitterRetry(
+    total=3, connect=3, read=2, status=3, backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+# Nos anexos o corpo é lido em streaming e não pode ser reenviado depois de
+# consumido, então só a abertura da conexão é repetida.
+UPLOAD_RETRY = JitterRetry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.5)
+
+# Sessão HTTP única: mantém a conexão com api.telegram.org aberta (keep-alive)
+# e evita um novo handshake TCP+TLS a cada envio.
+session = requests.Session()
+session.verify = certifi.where()
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=UPLOAD_RETRY))
+session.mount(SEND_MESSAGE_URL, HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=MESSAGE_RETRY))
+
 def sanitize_html(text):
     text = str(text)
     text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
     text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', text)
     return text
 
+def compile_template(template):
+    # Separa uma única vez as partes fixas do template e os campos {nome}; cada
+    # chamada só escapa os valores (sanitize_html) e junta tudo num "".join.
+    parts = re.split(r'\{(\w+)\}', template)
+    literals = parts[0::2]
+    fields = parts[1::2]
+
+    def render(**values):
+        out = [literals[0]]
+        for field, literal in zip(fields, literals[1:]):
+            out.append(sanitize_html(values[field]))
+            out.append(literal)
+        return "".join(out)
+    return render
+
+EMAIL_TEMPLATE = compile_template("<b>Novo e-mail!</b>\n<b>De:</b> {sender}\n<b>Assunto:</b> {subject}\n\n{body}")
+
+TRUNCATION_NOTICE = "\n\n(Mensagem truncada pelo limite do Telegram)"
+
 def build_telegram_message(sender, subject, body, max_length=4000):
-    message = f"<b>Novo e-mail!</b>\n<b>De:</b> {sender}\n<b>Assunto:</b> {subject}\n\n{body}"
-    if len(message) > max_length:
-        message = message[:(max_length-40)] + "\n\n(Mensagem truncada pelo limite do Telegram)"
-    return message
+    # Recebe os valores sem escape. O corpo (último campo do template) é
+    # cortado ainda cru, no espaço que sobra depois do cabeçalho escapado, e só
+    # então escapado: a mensagem final nunca é fatiada, então nenhuma entidade
+    # (&amp;) fica partida, e e-mails enormes não são escapados por inteiro.
+    body = str(body)
+    header = EMAIL_TEMPLATE(sender=sender, subject=subject, body="")
+    budget = max_length - len(header)
+    if len(body) <= budget:
+        escaped = sanitize_html(body)
+        if len(escaped) <= budget:
+            return header + escaped
+    budget -= len(TRUNCATION_NOTICE)
+    n = max(budget, 0)
+    escaped = sanitize_html(body[:n])
+    # O escape pode alongar o trecho (& vira &amp;): encolhe o corte cru na
+    # proporção do excesso até caber
+    while n > 0 and len(escaped) > budget:
+        n = min(n - 1, n * budget // len(escaped))
+        escaped = sanitize_html(body[:n])
+    return header + escaped + TRUNCATION_NOTICE
 
 def normalize_filename(fname):
     fname = re.sub(r'[^\w\-. ]', '_', fname)
@@ -34,171 +142,632 @@ def normalize_filename(fname):
         fname = "anexo_sem_titulo"
     return fname
 
+class CircuitBreaker:
+    """Após falhas seguidas, recusa chamadas por reset_timeout segundos e então
+    libera uma única tentativa de teste antes de voltar ao normal."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return self.state == "closed"
+
+    def on_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def on_abort(self):
+        # A chamada desistiu antes de chegar à API: se era a tentativa de
+        # teste, volta a open para liberar outra após reset_timeout
+        with self.lock:
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+class TokenBucket:
+    """Limita a taxa de chamadas: repõe `rate` fichas por segundo, acumulando até
+    `capacity`. Cada consume() gasta uma ficha e espera se não houver nenhuma."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Saldo negativo reserva a próxima ficha para esta chamada
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+# Limites do Telegram para bots: ~30 mensagens/s no total e ~20 mensagens/min por grupo
+RATE_GLOBAL = float(os.getenv("TELEGRAM_RATE_GLOBAL", "30"))            # mensagens por segundo
+RATE_PER_CHAT = float(os.getenv("TELEGRAM_RATE_PER_CHAT", "20")) / 60   # mensagens por minuto
+global_bucket = TokenBucket(RATE_GLOBAL, capacity=RATE_GLOBAL)
+_chat_buckets = {}
+_chat_buckets_lock = threading.Lock()
+
+def throttle_telegram(chat_id):
+    # Espera até que o envio caiba nos limites global e do chat
+    with _chat_buckets_lock:
+        bucket = _chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _chat_buckets[chat_id] = TokenBucket(RATE_PER_CHAT, capacity=3)
+    global_bucket.consume()
+    bucket.consume()
+
+# Bulkhead: limita as requisições simultâneas ao Telegram; se não houver vaga
+# dentro do prazo, o envio falha na hora em vez de acumular conexões.
+MAX_INFLIGHT = int(os.getenv("TELEGRAM_MAX_INFLIGHT", "8"))
+BULKHEAD_TIMEOUT = 30
+telegram_bulkhead = threading.BoundedSemaphore(MAX_INFLIGHT)
+
+def _post_telegram(url, **kwargs):
+    # Devolve None se o limite de requisições simultâneas não liberar a tempo
+    throttle_telegram(CHAT_ID)
+    if not telegram_bulkhead.acquire(timeout=BULKHEAD_TIMEOUT):
+        return None
+    try:
+        return session.post(url, **kwargs)
+    finally:
+        telegram_bulkhead.release()
+
+# Um disjuntor por método da API, para texto e anexos abrirem de forma independente
+telegram_breakers = {
+    "sendMessage": CircuitBreaker(),
+    "sendDocument": CircuitBreaker(),
+}
+
+def is_telegram_outage(e):
+    # Erros 4xx (exceto 429) indicam problema na requisição, não indisponibilidade da API
+    response = getattr(e, 'response', None)
+    if response is None:
+        return True
+    return response.status_code >= 500 or response.status_code == 429
+
 def send_telegram_text(text, subject='', sender=''):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    data = {
-        "chat_id": CHAT_ID,
-        "text": text,
-        "parse_mode": "HTML"
-    }
+    breaker = telegram_breakers["sendMessage"]
+    if not breaker.allow():
+        log.warning("Telegram indisponível; texto do e-mail '%s' de '%s' não enviado.", subject, sender)
+        return False
+    payload = MESSAGE_TEMPLATE.copy()
+    payload["text"] = text
     try:
-        r = requests.post(url, data=data, timeout=10, verify=certifi.where())
+        # Corpo JSON já serializado; a resposta só é lida em caso de erro
+        body, headers = json_dumps(payload), JSON_HEADERS
+        if COMPRESS and len(body) > COMPRESS_MIN_BYTES:
+            body, headers = gzip.compress(body, compresslevel=1), GZIP_JSON_HEADERS
+        r = _post_telegram(SEND_MESSAGE_URL, data=body, headers=headers, timeout=10)
+        if r is None:
+            log.warning("Envios demais em andamento; texto do e-mail '%s' de '%s' não enviado.", subject, sender)
+            breaker.on_abort()
+            return False
         r.raise_for_status()
-        print("Texto enviado ao Telegram.")
+        breaker.on_success()
+        log.info("Texto enviado ao Telegram.")
+        return True
     except Exception as e:
-        print(f"Erro ao enviar texto ao Telegram: {e}")
+        if is_telegram_outage(e):
+            breaker.on_failure()
+        else:
+            # A API respondeu (erro 4xx do próprio pedido): o serviço está no
+            # ar, então o disjuntor fecha, inclusive após a tentativa de teste
+            breaker.on_success()
+        log.error("Erro ao enviar texto ao Telegram: %s", e)
         if hasattr(e, 'response') and e.response is not None:
-            print(f"Detalhe do erro: {e.response.text}")
-            print(f"Falha no envio do e-mail com assunto: '{subject}' de '{sender}'.")
-
-def send_telegram_file(filename, file_bytes, mime_type="application/octet-stream"):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendDocument"
-    files = {
-        "document": (filename, file_bytes, mime_type)
-    }
-    data = {
-        "chat_id": CHAT_ID
-    }
+            log.error("Detalhe do erro: %s", e.response.text)
+            log.error("Falha no envio do e-mail com assunto: '%s' de '%s'.", subject, sender)
+        return False
+
+MMAP_THRESHOLD = 1024 * 1024  # Arquivos maiores que isso são mapeados em memória
+
+class MappedFile:
+    """Arquivo mapeado em memória (somente leitura) para o MultipartEncoder.
+    `len` informa os bytes que faltam ler: len(mmap) é sempre o tamanho total
+    e faria o encoder nunca terminar."""
+
+    def __init__(self, fileno):
+        self.mm = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    @property
+    def len(self):
+        return len(self.mm) - self.mm.tell()
+
+    def read(self, size=-1):
+        return self.mm.read(size)
+
+    def close(self):
+        self.mm.close()
+
+def _open_upload(path):
+    # Arquivos grandes são mapeados em memória; os demais, abertos normalmente
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            # O mapeamento mantém seu próprio handle; o arquivo pode ser fechado
+            return MappedFile(f.fileno())
+    return open(path, "rb")
+
+def _send_document(filename, fileobj, mime_type):
+    breaker = telegram_breakers["sendDocument"]
+    if not breaker.allow():
+        log.warning("Telegram indisponível; anexo %s não enviado.", filename)
+        return False
     try:
-        r = requests.post(url, data=data, files=files, timeout=20, verify=certifi.where())
+        # O MultipartEncoder lê o arquivo em blocos durante o envio, sem montar o
+        # corpo inteiro da requisição em memória.
+        fields = DOCUMENT_TEMPLATE.copy()
+        fields["document"] = (filename, fileobj, mime_type)
+        encoder = MultipartEncoder(fields=fields)
+        # Content-Length explícito, tirado do encoder.len (o mesmo valor que o
+        # requests usaria), para aparecer nos cabeçalhos do log de depuração
+        headers = {"Content-Type": encoder.content_type, "Content-Length": str(encoder.len)}
+        r = _post_telegram(SEND_DOCUMENT_URL, data=encoder, headers=headers, timeout=20)
+        if r is None:
+            log.warning("Envios demais em andamento; anexo %s não enviado.", filename)
+            breaker.on_abort()
+            return False
+        log.debug("Cabeçalhos do envio do anexo %s: %s", filename, r.request.headers)
         r.raise_for_status()
-        print(f"Arquivo {filename} enviado ao Telegram.")
+        breaker.on_success()
+        log.info("Arquivo %s enviado ao Telegram.", filename)
+        return True
     except Exception as e:
-        print(f"Erro ao enviar anexo ao Telegram: {e}")
+        if is_telegram_outage(e):
+            breaker.on_failure()
+        else:
+            breaker.on_success()
+        log.error("Erro ao enviar anexo ao Telegram: %s", e)
         if hasattr(e, 'response') and e.response is not None:
-            print(f"Detalhe do erro: {e.response.text}")
+            log.error("Detalhe do erro: %s", e.response.text)
+        return False
+
+def send_telegram_file_from_path(path, filename=None, mime_type="application/octet-stream"):
+    filename = filename or os.path.basename(path)
+    try:
+        fileobj = _open_upload(path)
+    except OSError as e:
+        log.error("Erro ao abrir o anexo %s: %s", filename, e)
+        return False
+    try:
+        return _send_document(filename, fileobj, mime_type)
+    finally:
+        fileobj.close()
+
+def send_telegram_file_from_bytes(data, filename="file.dat", mime_type="application/octet-stream"):
+    return _send_document(filename, io.BytesIO(data), mime_type)
+
+def send_telegram_file_from_fileobj(fileobj, filename=None, mime_type="application/octet-stream"):
+    filename = filename or os.path.basename(getattr(fileobj, "name", "")) or "file.dat"
+    return _send_document(filename, fileobj, mime_type)
+
+def send_telegram_file(filename, file_data, mime_type="application/octet-stream"):
+    # Aceita caminho, bytes ou arquivo aberto e repassa para a variante específica;
+    # quem já sabe o tipo pode chamar send_telegram_file_from_* diretamente.
+    if isinstance(file_data, str):
+        return send_telegram_file_from_path(file_data, filename, mime_type)
+    if isinstance(file_data, (bytes, bytearray, memoryview)):
+        return send_telegram_file_from_bytes(file_data, filename or "file.dat", mime_type)
+    return send_telegram_file_from_fileobj(file_data, filename, mime_type)
+
+# Fila de envios ao Telegram, consumida por uma única thread em segundo plano:
+# o loop do Outlook só enfileira e segue, e a ordem dos envios é preservada.
+telegram_queue = queue.Queue(maxsize=100)
+_telegram_worker = None
+_STOP = object()  # Sinal para a thread de envio encerrar
+_em_envio = set()  # EntryIDs enfileirados que ainda não foram gravados no banco
+
+# Janela (ms) para juntar textos consecutivos numa só mensagem; 0 desativa
+COALESCE_MS = int(os.getenv("TELEGRAM_COALESCE_MS", "0"))
+TELEGRAM_TEXT_LIMIT = 4096
+
+def _coalesce_texts(text, subject, sender):
+    # Junta os próximos textos da fila que chegarem dentro da janela, até o
+    # limite do Telegram; textos idênticos ao anterior são descartados.
+    # Devolve o texto combinado e os jobs retirados da fila que ainda devem
+    # rodar, em ordem: registros no banco adiados e o job que interrompeu a junção.
+    last_hash = hashlib.sha1(text.encode("utf-8")).digest()
+    adiados = []
+    while True:
+        try:
+            job = telegram_queue.get(timeout=COALESCE_MS / 1000)
+        except queue.Empty:
+            return text, adiados
+        if job is not _STOP and job[0] is _registrar_enviados:
+            # Só pode gravar o e-mail depois que o texto combinado for enviado
+            adiados.append(job)
+            continue
+        if job is _STOP or job[0] is not send_telegram_text:
+            adiados.append(job)
+            return text, adiados
+        next_text = job[1][0]
+        next_hash = hashlib.sha1(next_text.encode("utf-8")).digest()
+        if next_hash == last_hash:
+            log.info("Texto repetido descartado: e-mail '%s' de '%s'.", job[1][1], job[1][2])
+        elif len(text) + 1 + len(next_text) <= TELEGRAM_TEXT_LIMIT:
+            text = f"{text}\n{next_text}"
+            last_hash = next_hash
+        else:
+            return text, job
+        telegram_queue.task_done()
+
+def _telegram_worker_loop():
+    pending = []  # Jobs já retirados da fila pela junção de textos
+    while True:
+        job = pending.pop(0) if pending else telegram_queue.get()
+        try:
+            if job is _STOP:
+                return
+            func, args = job
+            if COALESCE_MS > 0 and func is send_telegram_text:
+                text, pending = _coalesce_texts(*args)
+                args = (text,) + args[1:]
+            func(*args)
+        except Exception as e:
+            log.error("Erro no envio em segundo plano: %s", e)
+        finally:
+            telegram_queue.task_done()
+
+def enqueue_telegram(func, *args):
+    global _telegram_worker
+    if _telegram_worker is None:
+        _telegram_worker = threading.Thread(target=_telegram_worker_loop, name="telegram", daemon=True)
+        _telegram_worker.start()
+    # Bloqueia se a fila estiver cheia, em vez de descartar envios
+    telegram_queue.put((func, args))
+
+def stop_telegram_worker():
+    # Envia o que ainda está na fila e encerra a thread
+    global _telegram_worker
+    if _telegram_worker is not None:
+        restantes = telegram_queue.qsize()
+        if restantes:
+            # Com o limite de taxa, esvaziar a fila pode levar alguns minutos
+            log.info("Enviando %d item(ns) ainda na fila do Telegram antes de encerrar...", restantes)
+        telegram_queue.put(_STOP)
+        _telegram_worker.join()
+        _telegram_worker = None
+
+_pending_bytes = 0  # Bytes de anexos salvos que ainda aguardam envio
+_pending_cond = threading.Condition()
+
+def enviar_anexo_salvo(fname, temp_path, size):
+    global _pending_bytes
+    try:
+        send_telegram_file_from_path(temp_path, fname)
+    finally:
+        os.remove(temp_path)
+        with _pending_cond:
+            _pending_bytes -= size
+            _pending_cond.notify_all()
+
+def preparar_pasta_anexos():
+    os.makedirs(ATTACH_DIR, exist_ok=True)
+    # Remove sobras de execuções anteriores interrompidas no meio de um envio
+    for nome in os.listdir(ATTACH_DIR):
+        try:
+            os.remove(os.path.join(ATTACH_DIR, nome))
+        except OSError:
+            pass
+
+def enviar_anexos(attachments):
+    # SaveAsFile precisa rodar nesta thread (COM/STA); a leitura e o
+    # envio ficam na thread da fila, sobrepondo disco e rede.
+    global _pending_bytes
+    item = attachments.Item
+    for i in range(attachments.Count):
+        attachment = item(i+1)
+        fname = normalize_filename(attachment.FileName)
+        ext = os.path.splitext(fname)[1].lower()
+        if ext in SKIP_IMAGE_EXTENSIONS:
+            log.info("Anexo '%s' ignorado (imagem: %s)", fname, ext)
+            continue
+        size = attachment.Size
+        if size < MIN_ATTACHMENT_BYTES:
+            log.info("Anexo '%s' ignorado (%d bytes, abaixo do mínimo)", fname, size)
+            continue
+        # Aguarda envios anteriores se os arquivos pendentes passarem do limite
+        with _pending_cond:
+            _pending_cond.wait_for(lambda: _pending_bytes == 0 or _pending_bytes + size <= MAX_PENDING_BYTES)
+            _pending_bytes += size
+        fd, temp_path = tempfile.mkstemp(suffix="_" + fname, dir=ATTACH_DIR)
+        os.close(fd)
+        try:
+            attachment.SaveAsFile(temp_path)
+        except Exception:
+            os.remove(temp_path)
+            with _pending_cond:
+                _pending_bytes -= size
+                _pending_cond.notify_all()
+            raise
+        enqueue_telegram(enviar_anexo_salvo, fname, temp_path, size)
 
 def escolher_conta(outlook):
-    print("Contas encontradas no Outlook:")
-    for i, folder in enumerate(outlook.Folders):
-        print(f"{i}: {folder.Name}")
+    # Lê a coleção de contas do Outlook uma única vez (cada acesso é uma chamada COM)
+    contas = list(outlook.Folders)
+    linhas = [f"{i}: {folder.Name}" for i, folder in enumerate(contas)]
+    sys.stdout.write("Contas encontradas no Outlook:\n" + "\n".join(linhas) + "\n")
     while True:
         try:
             idx = int(input("Digite o número da conta desejada: "))
-            if 0 <= idx < len(outlook.Folders):
-                return outlook.Folders[idx]
+            if 0 <= idx < len(contas):
+                return contas[idx]
             else:
                 print("Número inválido. Tente novamente.")
         except ValueError:
             print("Digite um número válido.")
 
+# Consultas frequentes como constantes: o texto idêntico a cada chamada
+# reaproveita o statement já preparado no cache do sqlite3
+SQL_INSERT_SENT = "INSERT OR IGNORE INTO sent_emails (entry_id, sent_at) VALUES (?, ?)"
+SQL_LAST_CHECKPOINT = "SELECT entry_id FROM sent_emails ORDER BY sent_at DESC LIMIT 1"
+SQL_ALREADY_SENT = "SELECT 1 FROM sent_emails WHERE entry_id = ?"
+SQL_RECENT_SENT = "SELECT entry_id FROM sent_emails ORDER BY sent_at DESC LIMIT ?"
+SENT_IDS_CACHE = 1000  # Quantos EntryIDs recentes ficam em memória
+
+_db_conn = None
+_db_lock = threading.Lock()  # A conexão é usada pela thread principal e pela de envio
+_sent_ids = {}  # EntryIDs gravados mais recentes (dict usado como conjunto ordenado)
+_last_sent_at = 0  # Maior sent_at no banco (lido em init_db); os próximos são sempre maiores
+
+def get_db():
+    # Conexão única, aberta na primeira chamada e reaproveitada por todo o processo
+    global _db_conn
+    if _db_conn is None:
+        # Os registros de envio são gravados pela thread de envio (veja
+        # registrar_apos_envios); os acessos passam por _db_lock.
+        _db_conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        # WAL + synchronous=NORMAL: um fsync a menos por commit; mmap e cache
+        # maiores reduzem leituras de disco nas consultas.
+        _db_conn.execute("PRAGMA journal_mode=WAL")
+        _db_conn.execute("PRAGMA synchronous=NORMAL")
+        _db_conn.execute("PRAGMA mmap_size=268435456")
+        _db_conn.execute("PRAGMA cache_size=-65536")
+    return _db_conn
+
+def close_db():
+    global _db_conn
+    if _db_conn is not None:
+        _db_conn.close()
+        _db_conn = None
+
+def now_micros():
+    return time.time_ns() // 1000
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS sent_emails (
-            entry_id TEXT PRIMARY KEY,
-            sent_at TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
+    global _last_sent_at
+    conn = get_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sent_emails (
+                entry_id TEXT PRIMARY KEY,
+                sent_at INTEGER NOT NULL
+            )
+        """)
+    migrate_sent_at(conn)
+    # Índice de cobertura: get_last_checkpoint resolve só pelo índice, sem ler a tabela
+    with conn:
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sent_emails_sent_at
+            ON sent_emails (sent_at DESC, entry_id)
+        """)
+    # Parte do maior sent_at gravado: mesmo com o relógio atrasado após reiniciar,
+    # os novos registros continuam depois dos antigos
+    _last_sent_at = conn.execute("SELECT MAX(sent_at) FROM sent_emails").fetchone()[0] or 0
+    recentes = [row[0] for row in conn.execute(SQL_RECENT_SENT, (SENT_IDS_CACHE,))]
+    _sent_ids.clear()
+    _lembrar_enviados(reversed(recentes))
+
+def migrate_sent_at(conn):
+    # Bancos antigos guardavam sent_at como texto "dd/mm/aaaa - hh:mm", que não
+    # ordena cronologicamente; converte para microssegundos desde a época (INTEGER).
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(sent_emails)")}
+    if columns.get("sent_at", "").upper() == "INTEGER":
+        return
+    rows = []
+    for entry_id, sent_at in conn.execute("SELECT entry_id, sent_at FROM sent_emails"):
+        try:
+            dt = datetime.datetime.strptime(sent_at, DATE_FORMAT)
+            rows.append((entry_id, int(dt.timestamp() * 1_000_000)))
+        except (TypeError, ValueError):
+            rows.append((entry_id, 0))
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE sent_emails RENAME TO sent_emails_old")
+        conn.execute("""
+            CREATE TABLE sent_emails (
+                entry_id TEXT PRIMARY KEY,
+                sent_at INTEGER NOT NULL
+            )
+        """)
+        conn.executemany("INSERT INTO sent_emails (entry_id, sent_at) VALUES (?, ?)", rows)
+        conn.execute("DROP TABLE sent_emails_old")
+    log.info("Banco de dados migrado: %d registro(s) convertido(s).", len(rows))
+
+def _lembrar_enviados(entry_ids):
+    for entry_id in entry_ids:
+        _sent_ids[entry_id] = None
+    # Descarta os mais antigos; se reaparecerem, already_sent consulta o banco
+    while len(_sent_ids) > SENT_IDS_CACHE:
+        del _sent_ids[next(iter(_sent_ids))]
 
 def already_sent(entry_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM sent_emails WHERE entry_id = ?", (entry_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result is not None
+    # Os EntryIDs mais recentes respondem da memória; os demais, pela chave
+    # primária no SQLite.
+    if entry_id in _sent_ids:
+        return True
+    with _db_lock:
+        return get_db().execute(SQL_ALREADY_SENT, (entry_id,)).fetchone() is not None
+
+def mark_many_as_sent(entry_ids):
+    # Grava todos os EntryIDs numa única transação (um commit para o lote).
+    # Cada linha recebe um sent_at maior que o anterior, na ordem recebida,
+    # para o marco (maior sent_at) ser sempre o último item processado.
+    global _last_sent_at
+    base = max(now_micros(), _last_sent_at + 1)
+    rows = [(entry_id, base + i) for i, entry_id in enumerate(entry_ids)]
+    conn = get_db()
+    with _db_lock, conn:
+        conn.executemany(SQL_INSERT_SENT, rows)
+    _last_sent_at = base + len(rows) - 1
+    _lembrar_enviados(entry_ids)
 
 def mark_as_sent(entry_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO sent_emails (entry_id, sent_at) VALUES (?, ?)",
-        (entry_id, datetime.datetime.now().strftime("%d/%m/%Y - %H:%M"))
-    )
-    conn.commit()
-    conn.close()
+    mark_many_as_sent((entry_id,))
+
+def _registrar_enviados(entry_ids):
+    # Roda na thread de envio, depois dos jobs de texto e anexos dos e-mails
+    mark_many_as_sent(entry_ids)
+    _em_envio.difference_update(entry_ids)
+
+def registrar_apos_envios(entry_ids):
+    # Enfileira o registro no banco atrás dos envios já enfileirados: o e-mail
+    # só é marcado como enviado depois que a thread concluiu texto e anexos.
+    # Até lá fica em _em_envio, para o próximo ciclo não processá-lo de novo.
+    _em_envio.update(entry_ids)
+    enqueue_telegram(_registrar_enviados, list(entry_ids))
 
 def get_last_checkpoint():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT entry_id FROM sent_emails ORDER BY sent_at DESC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
+    with _db_lock:
+        row = get_db().execute(SQL_LAST_CHECKPOINT).fetchone()
     if row:
         return row[0]
     return None
 
 def set_initial_checkpoint(entry_id):
     mark_as_sent(entry_id)
-    print(f"Primeira execução: Definindo marco inicial. EntryID inicial: {entry_id}")
+    log.info("Primeira execução: Definindo marco inicial. EntryID inicial: %s", entry_id)
+
+stop_event = threading.Event()  # Sinaliza o fim do monitoramento (ex.: SIGTERM)
+
+def aguardar_ate(deadline):
+    # Espera até o horário do próximo ciclo ou até o pedido de parada.
+    # Usa fatias de até 1 s porque no Windows a espera num Event não é
+    # interrompida pelo Ctrl+C; assim o encerramento continua imediato.
+    while not stop_event.is_set():
+        restante = deadline - time.monotonic()
+        if restante <= 0:
+            return True
+        stop_event.wait(min(restante, 1))
+    return False
 
 def monitorar_caixa_entrada():
-    print("Abrindo Outlook...")
+    # Importado só aqui: o restante do módulo (envio ao Telegram, banco) não
+    # depende do pywin32 e pode ser importado sem carregar o COM.
+    import win32com.client
+
+    log.info("Abrindo Outlook...")
     outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
     conta = escolher_conta(outlook)
     inbox = conta.Folders["Caixa de Entrada"]
-    mensagens = inbox.Items
-    mensagens.Sort("[ReceivedTime]", True)
 
     init_db()
+    preparar_pasta_anexos()
     last_checkpoint = get_last_checkpoint()
 
     if not last_checkpoint:
         # Primeira execução: define o marco zero, não processa e-mail algum
-        if len(mensagens) > 0:
-            entry_id = mensagens[0].EntryID
+        mensagens = inbox.Items
+        mensagens.Sort("[ReceivedTime]", True)
+        primeira = mensagens.GetFirst()
+        if primeira is not None:
+            entry_id = primeira.EntryID
             set_initial_checkpoint(entry_id)
-            print("Marcação de marco inicial realizada. Os e-mails anteriores não serão processados.")
+            log.info("Marcação de marco inicial realizada. Os e-mails anteriores não serão processados.")
         else:
-            print("Nenhum e-mail na caixa de entrada. Vai monitorar os próximos.")
+            log.info("Nenhum e-mail na caixa de entrada. Vai monitorar os próximos.")
         last_checkpoint = get_last_checkpoint()
 
-    print("Monitorando novos e-mails a cada 5 minutos...\n")
-    while True:
-        time.sleep(300)
+    log.info("Monitorando novos e-mails a cada %g minuto(s)...\n", POLL_INTERVAL / 60)
+    # Ciclos agendados por prazo: o tempo gasto processando não atrasa o próximo
+    deadline = time.monotonic() + POLL_INTERVAL
+    while aguardar_ate(deadline):
+        deadline = max(deadline + POLL_INTERVAL, time.monotonic())
         mensagens = inbox.Items
         mensagens.Sort("[ReceivedTime]", True)
         novos = []
-        for msg in mensagens:
+        # GetFirst/GetNext percorre a coleção ordenada sob demanda e para no
+        # marco, sem materializar todos os itens da pasta.
+        # GetNext é resolvido uma vez só: no win32com cada acesso a atributo
+        # passa pelo __getattr__ dinâmico do objeto COM.
+        get_next = mensagens.GetNext
+        msg = mensagens.GetFirst()
+        while msg is not None:
             entry_id = msg.EntryID
             if entry_id == last_checkpoint:
                 break
-            if already_sent(entry_id):
-                continue
-            novos.append(msg)
+            if entry_id not in _em_envio and not already_sent(entry_id):
+                novos.append((entry_id, msg))
+            msg = get_next()
         if novos:
-            print(f"{len(novos)} novo(s) e-mail(is) recebido(s).")
-            for msg in reversed(novos):
-                entry_id = msg.EntryID
+            log.info("%d novo(s) e-mail(is) recebido(s).", len(novos))
+            ignorados = []
+            for entry_id, msg in reversed(novos):
                 try:
-                    # Garante que só processa itens do tipo "MailItem"
-                    if not hasattr(msg, "Class") or msg.Class != 43:
-                        print(f"Item ignorado (não é e-mail ou tipo desconhecido). EntryID: {entry_id}")
-                        mark_as_sent(entry_id)
+                    # Garante que só processa itens do tipo "MailItem".
+                    # Cada acesso a propriedade é uma chamada COM: lê Class uma vez só.
+                    if getattr(msg, "Class", None) != 43:
+                        log.info("Item ignorado (não é e-mail ou tipo desconhecido). EntryID: %s", entry_id)
+                        ignorados.append(entry_id)
                         continue
 
-                    subject = sanitize_html(msg.Subject or '(Sem assunto)')
-                    sender = sanitize_html(msg.SenderName or '(Sem remetente)')
-                    body = sanitize_html(msg.Body or '(Sem corpo de texto)')
+                    # Grava antes os ignorados pendentes, mantendo a ordem do marco
+                    if ignorados:
+                        registrar_apos_envios(ignorados)
+                        ignorados = []
+                    subject = msg.Subject or '(Sem assunto)'
+                    sender = msg.SenderName or '(Sem remetente)'
+                    body = msg.Body or '(Sem corpo de texto)'
                     text = build_telegram_message(sender, subject, body)
-                    send_telegram_text(text, subject, sender)
-                    attachments = msg.Attachments
-                    for i in range(attachments.Count):
-                        attachment = attachments.Item(i+1)
-                        fname = normalize_filename(attachment.FileName)
-                        ext = os.path.splitext(fname)[1].lower()
-                        if ext in SKIP_IMAGE_EXTENSIONS:
-                            print(f"Anexo '{fname}' ignorado (imagem: {ext})")
-                            continue
-                        temp_path = os.path.join(os.getcwd(), fname)
-                        attachment.SaveAsFile(temp_path)
-                        with open(temp_path, "rb") as f:
-                            file_bytes = f.read()
-                        send_telegram_file(fname, file_bytes)
-                        os.remove(temp_path)
-                        time.sleep(3)
-                    mark_as_sent(entry_id)
+                    enqueue_telegram(send_telegram_text, text, subject, sender)
+                    enviar_anexos(msg.Attachments)
+                    registrar_apos_envios((entry_id,))
                 except Exception as e:
-                    print(f"Erro ao processar novo e-mail: {e}")
+                    log.error("Erro ao processar novo e-mail: %s", e)
+            if ignorados:
+                registrar_apos_envios(ignorados)
             # Atualiza o marco para o próximo ciclo
             last_checkpoint = get_last_checkpoint()
-        else:
-            agora = datetime.datetime.now().strftime("%d/%m/%Y - %H:%M")
-            print(f"{agora} --> Nenhum e-mail novo.")
+        elif log.isEnabledFor(logging.INFO):
+            # strftime só é chamado se a mensagem for de fato exibida
+            log.info("%s --> Nenhum e-mail novo.", datetime.datetime.now().strftime(DATE_FORMAT))
 
 if __name__ == "__main__":
-    monitorar_caixa_entrada()
+    # A escrita no console fica numa thread própria (QueueListener); quem loga
+    # só enfileira o registro e não espera o stdout.
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    log_queue = queue.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, console)
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+    log_listener.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    try:
+        monitorar_caixa_entrada()
+    finally:
+        stop_telegram_worker()
+        session.close()
+        close_db()
+        log_listener.stop()